@@ -1,9 +1,40 @@
 # Replace old imports with new ones from langchain-community and langchain-openai
-import time
+import asyncio
+from functools import lru_cache
+import faiss
+import numpy as np
+import tiktoken
+from cachetools import LRUCache
 from langchain_community.chat_models import ChatOpenAI
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from redis import Redis
+from tenacity import AsyncRetrying, retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from state import MessageStore
+
+
+DEFAULT_SYSTEM_PROMPT = "Ты помошник."
+RAG_SYSTEM_PROMPT = "Ты помошник. Твое имя РАГ."
+# cl100k_base is the encoding of the gpt-3.5-turbo and gpt-4 families
+_ENCODER = tiktoken.get_encoding("cl100k_base")
+
+
+def is_rate_limit_error(e: BaseException) -> bool:
+    return "429" in str(e)
+
+
+# Backoff state lives in each call, and the jitter keeps clients that were
+# rate limited together from retrying together.
+RATE_LIMIT_RETRY = dict(retry=retry_if_exception(is_rate_limit_error), wait=wait_exponential_jitter(initial=1, max=60),
+                        stop=stop_after_attempt(6), reraise=True)
+
+
+# Keyed by content rather than by message object: histories are rebuilt from
+# Redis, so the same text comes back as new objects on every load.
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    return len(_ENCODER.encode(text))
 
 
 class GPT:
@@ -11,9 +42,9 @@ class GPT:
     Represents a chatbot that uses the OpenAI chat model GPT-4.
 
     Attributes:
-        messages (dict): A dictionary to store the messages for each user.
+        messages (MessageStore): The messages of each user, kept in Redis.
         chat (ChatOpenAI): An instance of ChatOpenAI for generating responses.
-        retry_delay (float): Initial delay in seconds for retrying after a rate limit error.
+        cache (SemanticCache): Answers to past queries, looked up by query meaning.
 
     Methods:
         new_rag(username: str, rag_content: str) -> None:
@@ -21,48 +52,226 @@ class GPT:
 
         ask(username: str, query: str) -> str:
             Sends a query to the chat model and returns the response, handling retries on rate limit errors.
+            A query close enough to one the user already asked is answered from the cache.
+            The oldest exchanges are dropped from the history sent to the model once it
+            exceeds max_history_tokens.
+
+        ask_async(username: str, query: str) -> str:
+            Same as ask, but awaits the chat model. At most max_concurrency requests are in flight.
+
+        ask_stream(username: str, query: str):
+            Same as ask_async, but yields the response in chunks as the model generates it.
 
         reset(username: str) -> None:
             Resets the conversation for a given username.
+
+        reset_async(username: str) -> None:
+            Same as reset, without blocking the event loop on Redis.
     """
 
-    def __init__(self, api_key: str, retry_delay: float = 1.0) -> None:
+    def __init__(self, api_key: str, redis: Redis, max_concurrency: int = 20,
+                 max_history_tokens: int = 6000) -> None:
         """
         Initializes a ChatGPT 4 instance.
 
         Args:
             api_key (str): The API key for accessing the OpenAI chat model.
-            retry_delay (float): Initial delay for retries after rate limiting, in seconds.
+            redis (Redis): A client for the Redis server holding the conversations.
+            max_concurrency (int): Maximal number of chat requests in flight across all users.
+            max_history_tokens (int): Token budget of the conversation history sent with a query.
         """
-        self.messages = {}
-        self.chat = ChatOpenAI(openai_api_key=api_key, model='gpt-3.5 turbo')
-        self.retry_delay = retry_delay
+        self.messages = MessageStore(redis)
+        self.chat = ChatOpenAI(openai_api_key=api_key, model='gpt-3.5 turbo', streaming=True)
+        # The similarity threshold is calibrated for this model; ada-002 scores unrelated
+        # questions much higher
+        self.cache = SemanticCache(OpenAIEmbeddings(openai_api_key=api_key, model='text-embedding-3-small'))
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self.max_history_tokens = max_history_tokens
 
     def new_rag(self, username: str, rag_content: str) -> None:
-        self.messages[username] = [
-            SystemMessage(content="Ты помошник. Твое имя РАГ."),
+        self.cache.reset(username)
+        self.messages.set(username, [
+            SystemMessage(content=RAG_SYSTEM_PROMPT),
             HumanMessage(content=make_rag(rag_content)),
             AIMessage(content="Я понял. Я отвечу на выши вопросы по этоому документу.")
-        ]
+        ])
 
     def ask(self, username: str, query: str) -> str:
-        if username not in self.messages:
-            self.reset(username)
-        self.messages[username].append(HumanMessage(content=query))
-        try:
-            res = self.chat(self.messages[username])
-        except Exception as e:
-            if "429" in str(e):
-                time.sleep(self.retry_delay)  # Simple exponential backoff
-                self.retry_delay *= 2
-                return self.ask(username, query)
-            raise e
-        self.messages[username].append(res)
+        if self._start_conversation(username):
+            self.cache.reset(username)
+        query_vector = self.cache.embed(query)
+        answer = self.cache.lookup(username, query_vector)
+        if answer is not None:
+            self.messages.append(username, HumanMessage(content=query), AIMessage(content=answer))
+            return answer
+        query_message = HumanMessage(content=query)
+        res = self._invoke(self._history(username, query_message))
+        self.messages.append(username, query_message, res)
+        if res.content:
+            self.cache.add(username, query_vector, res.content)
+        return res.content
+
+    # The async variants run every message store call in a thread: they go to Redis
+    # and would otherwise block the event loop.
+    async def ask_async(self, username: str, query: str) -> str:
+        if await asyncio.to_thread(self._start_conversation, username):
+            self.cache.reset(username)
+        query_vector = await self.cache.aembed(query)
+        answer = self.cache.lookup(username, query_vector)
+        if answer is not None:
+            await asyncio.to_thread(self.messages.append, username,
+                                    HumanMessage(content=query), AIMessage(content=answer))
+            return answer
+        query_message = HumanMessage(content=query)
+        res = await self._ainvoke(await asyncio.to_thread(self._history, username, query_message))
+        await asyncio.to_thread(self.messages.append, username, query_message, res)
+        if res.content:
+            self.cache.add(username, query_vector, res.content)
         return res.content
 
+    async def ask_stream(self, username: str, query: str):
+        if await asyncio.to_thread(self._start_conversation, username):
+            self.cache.reset(username)
+        query_vector = await self.cache.aembed(query)
+        answer = self.cache.lookup(username, query_vector)
+        if answer is not None:
+            await asyncio.to_thread(self.messages.append, username,
+                                    HumanMessage(content=query), AIMessage(content=answer))
+            yield answer
+            return
+        query_message = HumanMessage(content=query)
+        parts = []
+        async for chunk in self._astream(await asyncio.to_thread(self._history, username, query_message)):
+            parts.append(chunk)
+            yield chunk
+        answer = "".join(parts)
+        await asyncio.to_thread(self.messages.append, username, query_message, AIMessage(content=answer))
+        # An empty answer would be served to every similar question after it
+        if answer:
+            self.cache.add(username, query_vector, answer)
+
+    def reset(self, username: str) -> None:
+        self.messages.set(username, [SystemMessage(content=DEFAULT_SYSTEM_PROMPT)])
+        self.cache.reset(username)
+
+    async def reset_async(self, username: str) -> None:
+        await asyncio.to_thread(self.messages.set, username, [SystemMessage(content=DEFAULT_SYSTEM_PROMPT)])
+        self.cache.reset(username)
+
+    def _start_conversation(self, username: str) -> bool:
+        # Returns whether a new conversation was started
+        if self.messages.get(username) is not None:
+            return False
+        self.messages.set(username, [SystemMessage(content=DEFAULT_SYSTEM_PROMPT)])
+        return True
+
+    def _history(self, username: str, query: HumanMessage) -> list:
+        # Returns the history to send with the query. A query is only recorded together
+        # with its answer, so after the system prompt (and, in a RAG conversation, the
+        # document with its acknowledgement) the stored history is complete
+        # query/answer pairs, and the oldest pairs are dropped to fit the token budget.
+        messages = self.messages.get(username)
+        keep = 3 if messages[0].content == RAG_SYSTEM_PROMPT else 1
+        history = messages[keep:]
+        total = sum(count_tokens(m.content) for m in messages) + count_tokens(query.content)
+        trimmed = False
+        while total > self.max_history_tokens and history:
+            total -= sum(count_tokens(m.content) for m in history[:2])
+            del history[:2]
+            trimmed = True
+        if trimmed:
+            self.messages.set(username, messages[:keep] + history)
+        return messages[:keep] + history + [query]
+
+    @retry(**RATE_LIMIT_RETRY)
+    def _invoke(self, messages: list) -> AIMessage:
+        return self.chat(messages)
+
+    # The semaphore is taken per attempt, so a request waiting out its backoff
+    # doesn't hold a slot.
+    @retry(**RATE_LIMIT_RETRY)
+    async def _ainvoke(self, messages: list) -> AIMessage:
+        async with self._sem:
+            return await self.chat.ainvoke(messages)
+
+    async def _astream(self, messages: list):
+        # Only opening the stream is retried: once chunks have been yielded, part of
+        # the answer is already shown. The slot is held until the stream ends.
+        async for attempt in AsyncRetrying(**RATE_LIMIT_RETRY):
+            with attempt:
+                await self._sem.acquire()
+                try:
+                    stream = self.chat.astream(messages)
+                    first = await anext(stream, None)
+                except BaseException:
+                    self._sem.release()
+                    raise
+        try:
+            if first is None:
+                return
+            yield first.content
+            async for chunk in stream:
+                yield chunk.content
+        finally:
+            self._sem.release()
+
+
+class SemanticCache:
+    """
+    Caches chat answers by the meaning of the query rather than its exact text.
+
+    Each user has an inner-product index over normalized query embeddings, so a lookup
+    is a hit when the cosine similarity to a past query reaches the threshold. Entries
+    are per user because an answer depends on that user's conversation. At most maxsize
+    users are kept, and the least recently used one is evicted with its index and
+    answers together.
+
+    Attributes:
+        embeddings (OpenAIEmbeddings): An instance of OpenAIEmbeddings for embedding queries.
+        threshold (float): Minimal cosine similarity for a cache hit.
+        entries (LRUCache): For each user, a FAISS index of past query embeddings and
+            the answers in the order of its entries.
+    """
+
+    def __init__(self, embeddings: OpenAIEmbeddings, threshold: float = 0.92, dim: int = 1536,
+                 maxsize: int = 10_000) -> None:
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.dim = dim
+        self.entries = LRUCache(maxsize=maxsize)
+
+    def embed(self, query: str) -> np.ndarray:
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    async def aembed(self, query: str) -> np.ndarray:
+        vector = np.asarray([await self.embeddings.aembed_query(query)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, username: str, query_vector: np.ndarray):
+        entry = self.entries.get(username)
+        if entry is None:
+            return None
+        index, answers = entry
+        if index.ntotal == 0:
+            return None
+        scores, ids = index.search(query_vector, 1)
+        if scores[0][0] < self.threshold:
+            return None
+        return answers[ids[0][0]]
+
+    def add(self, username: str, query_vector: np.ndarray, answer: str) -> None:
+        entry = self.entries.get(username)
+        if entry is None:
+            entry = self.entries[username] = (faiss.IndexFlatIP(self.dim), [])
+        index, answers = entry
+        index.add(query_vector)
+        answers.append(answer)
+
     def reset(self, username: str) -> None:
-        self.messages[username] = [SystemMessage(content="Ты помошник.")]
-        self.retry_delay = 1.0  # Reset delay on a new conversation
+        self.entries.pop(username, None)
 
 
 def make_rag(rag_content: str) -> str:
@@ -1,9 +1,16 @@
+import asyncio
+import fcntl
 import io
 import os
 import logging
-import telebot
+import time
+from cachetools import LRUCache
+from redis import Redis
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
 from utils import get_pdf_text, decode_text
 from gpt import GPT
+from state import DocumentStore
 from storage import VectorStorage
 from tenacity import retry, stop_after_attempt, wait_exponential
 
@@ -13,9 +20,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Initialize the bot and other components
 BOT_API_KEY = os.getenv('BOT_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 
-bot = telebot.TeleBot(BOT_API_KEY)
-chat = GPT(OPENAI_API_KEY)
+redis = Redis.from_url(REDIS_URL)
+bot = AsyncTeleBot(BOT_API_KEY)
+chat = GPT(OPENAI_API_KEY, redis)
 storage = VectorStorage(OPENAI_API_KEY)
 
 # Ensure that the keys are not None
@@ -25,20 +34,22 @@ if BOT_API_KEY is None or OPENAI_API_KEY is None:
 
 # Load "Master and Margarita" as the base document for all users
 @retry(wait=wait_exponential(multiplier=1, max=60), stop=stop_after_attempt(5))
-def initialize_storage_with_book():
+async def initialize_storage_with_book():
     try:
-        with open("book.pdf", "rb") as file:
-            raw_text = get_pdf_text(file)
-        storage.new_storage("book", raw_text)
+        # Workers ingest the book one at a time; whoever comes after the first finds it
+        # already stored and skips embedding. Closing the lock file releases the lock.
+        with open("book.pdf.lock", "w") as lock:
+            await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+            with open("book.pdf", "rb") as file:
+                raw_text = await asyncio.get_running_loop().run_in_executor(None, get_pdf_text, file)
+            await storage.new_storage_async("book", raw_text)
     except Exception as e:
         logging.error(f"Error initializing book storage: {e}")
 
-initialize_storage_with_book()
-
 # Welcome message for /start command
 @bot.message_handler(commands=['start'])
-def send_welcome_message(message):
-    bot.reply_to(message, "Привет! Я Раг. Для получения дополнительной информации введите /help. Вы можете начать с вопросов о 'Мастере и Маргарите'.")
+async def send_welcome_message(message):
+    await bot.reply_to(message, "Привет! Я Раг. Для получения дополнительной информации введите /help. Вы можете начать с вопросов о 'Мастере и Маргарите'.")
 
 # Help message content and handler
 help_message = """
@@ -51,78 +62,172 @@ help_message = """
 """
 
 @bot.message_handler(commands=['help'])
-def send_help_message(message):
-    bot.reply_to(message, help_message)
+async def send_help_message(message):
+    await bot.reply_to(message, help_message)
 
 # Handle document uploads and initialize user storage
-# Dictionary to track each user's documents
-user_documents = {}
+# Store tracking each user's documents
+user_documents = DocumentStore(redis)
+# Rendered document lists, dropped whenever the user's documents change
+rendered_documents = LRUCache(maxsize=10_000)
 
 
 # Function to display available documents
-def list_documents(user_id):
-    docs = user_documents.get(user_id, {})
-    return '\n'.join([f"{idx}: {doc}" for idx, doc in enumerate(docs.keys(), start=1)])
+# Document store calls go to Redis, so handlers run them in a thread to keep the event loop free
+async def list_documents(user_id):
+    rendered = rendered_documents.get(user_id)
+    if rendered is None:
+        docs = await asyncio.to_thread(user_documents.get, user_id)
+        # Numbers are doc_id + 1, which is what process_selection expects back
+        rendered = '\n'.join(f"{doc_id + 1}: {doc['name']}" for doc_id, doc in sorted(docs.items()))
+        rendered_documents[user_id] = rendered
+    return rendered
+
+
+# Function to record a new document and return the key its vectors are stored under
+def register_document(user_id, filename):
+    doc_id = user_documents.new_id(user_id)
+    # The text itself lives in the vector storage; keep only what is needed to find it
+    vec_key = f"{user_id}_{doc_id}"
+    user_documents.add(user_id, doc_id, {'name': filename, 'vec_key': vec_key})
+    return vec_key
 
 
 # Handle document uploads and store document metadata
 @bot.message_handler(content_types=['document'])
-def handle_document(message):
+async def handle_document(message):
     user_id = str(message.from_user.id)
-    file_info = bot.get_file(message.document.file_id)
+    file_info = await bot.get_file(message.document.file_id)
     file_extension = file_info.file_path.split('.')[-1].lower()
 
     try:
-        file_data = bot.download_file(file_info.file_path)
+        file_data = await bot.download_file(file_info.file_path)
         filename = message.document.file_name
-        raw_text = get_pdf_text(io.BytesIO(file_data)) if file_extension == 'pdf' else decode_text(file_data)
-        doc_id = len(user_documents.get(user_id, {}))
-        if user_id not in user_documents:
-            user_documents[user_id] = {}
-        user_documents[user_id][doc_id] = {'name': filename, 'text': raw_text}
-        storage.new_storage(f"{user_id}_{doc_id}", raw_text)
-        bot.reply_to(message,
+        if file_extension == 'pdf':
+            # Extraction is CPU-bound; keep it off the event loop so other users are served meanwhile
+            raw_text = await asyncio.get_running_loop().run_in_executor(None, get_pdf_text, io.BytesIO(file_data))
+        else:
+            raw_text = decode_text(file_data)
+        vec_key = await asyncio.to_thread(register_document, user_id, filename)
+        rendered_documents.pop(user_id, None)
+        await storage.new_storage_async(vec_key, raw_text)
+        await bot.reply_to(message,
                      f"Документ '{filename}' обработан! Используйте /select, чтобы выбрать документ для запросов.")
     except Exception as e:
         logging.error(f"Ошибка загрузки документа: {e}")
-        bot.reply_to(message, "Не удалось обработать документ. Пожалуйста, убедитесь, что это действительный файл.")
+        await bot.reply_to(message, "Не удалось обработать документ. Пожалуйста, убедитесь, что это действительный файл.")
 
 
 # Command to list and select documents
 @bot.message_handler(commands=['select'])
-def select_document(message):
+async def select_document(message):
     user_id = str(message.from_user.id)
-    if user_id not in user_documents or not user_documents[user_id]:
-        bot.reply_to(message, "Нет загруженных документов. Пожалуйста, сначала загрузите документ.")
+    if not await asyncio.to_thread(user_documents.get, user_id):
+        await bot.reply_to(message, "Нет загруженных документов. Пожалуйста, сначала загрузите документ.")
         return
-    doc_list = list_documents(user_id)
+    doc_list = await list_documents(user_id)
     msg = f"Пожалуйста, выберите документ по номеру:\n{doc_list}"
-    bot.reply_to(message, msg, parse_mode='Markdown')
+    # Sent as plain text: file names often contain '_' or '*', which Markdown parsing rejects
+    await bot.reply_to(message, msg)
 
 
 # Handler to process document selection
 @bot.message_handler(func=lambda message: message.text.isdigit())
-def process_selection(message):
+async def process_selection(message):
     user_id = str(message.from_user.id)
     doc_index = int(message.text) - 1
-    if user_id in user_documents and doc_index in user_documents[user_id]:
-        active_doc = user_documents[user_id][doc_index]
-        bot.reply_to(message,
+    docs = await asyncio.to_thread(user_documents.get, user_id)
+    if doc_index in docs:
+        active_doc = docs[doc_index]
+        await bot.reply_to(message,
                      f"Вы выбрали '{active_doc['name']}'. Теперь вы можете задавать вопросы об этом документе.")
     else:
-        bot.reply_to(message, "Неверный выбор. Используйте /select, чтобы посмотреть доступные документы.")
+        await bot.reply_to(message, "Неверный выбор. Используйте /select, чтобы посмотреть доступные документы.")
 
 
 # Reset user data and storage
 @bot.message_handler(commands=['reset'])
-def reset_user_data(message):
+async def reset_user_data(message):
+    user_id = str(message.from_user.id)
+    await chat.reset_async(user_id)
+    # Vectors are stored per document, under the key recorded at upload
+    for doc in (await asyncio.to_thread(user_documents.get, user_id)).values():
+        await asyncio.to_thread(storage.reset, doc['vec_key'])
+    await asyncio.to_thread(user_documents.delete, user_id)
+    rendered_documents.pop(user_id, None)
+    await bot.reply_to(message, "Ваши данные были сброшены. Начните снова, загрузив новый документ.")
+
+
+# Telegram rate-limits message edits to about one per second in a chat
+EDIT_INTERVAL = 1.0
+# Maximal length of the text of a Telegram message
+MESSAGE_LIMIT = 4096
+# How many times the final update is tried when Telegram rate-limits it
+FINAL_UPDATE_ATTEMPTS = 5
+
+
+# Function to show the answer so far, continued in new messages past the length limit.
+# Telegram errors are logged rather than raised, so a failed update never stops the answer
+# being generated and recorded; the next update retries it. The final update has no next
+# one, so it waits out rate limits instead.
+async def show_answer(message, replies, shown, answer, final=False):
+    if not answer.strip():
+        return
+    parts = [answer[i:i + MESSAGE_LIMIT] for i in range(0, len(answer), MESSAGE_LIMIT)]
+    attempts = FINAL_UPDATE_ATTEMPTS if final else 1
+    for attempt in range(attempts):
+        try:
+            # Continuations of a longer text shown before, e.g. a partial answer under an error
+            while len(replies) > len(parts):
+                await bot.delete_message(replies[-1].chat.id, replies[-1].message_id)
+                replies.pop()
+                shown.pop()
+            for i, part in enumerate(parts):
+                if i == len(replies):
+                    replies.append(await bot.send_message(message.chat.id, part))
+                    shown.append(part)
+                # Telegram rejects edits that don't change the text
+                elif part != shown[i]:
+                    await bot.edit_message_text(part, chat_id=replies[i].chat.id, message_id=replies[i].message_id)
+                    shown[i] = part
+            return
+        except ApiTelegramException as e:
+            if e.error_code != 429 or attempt == attempts - 1:
+                logging.warning(f"Не удалось обновить ответ: {e}")
+                return
+            await asyncio.sleep(e.result_json.get('parameters', {}).get('retry_after', EDIT_INTERVAL))
+
+
+# Answer any other text as a question; registered last so commands match first
+@bot.message_handler(content_types=['text'])
+async def answer_question(message):
     user_id = str(message.from_user.id)
-    chat.reset(user_id)
-    storage.reset(user_id)
-    user_documents.pop(user_id, None)
-    bot.reply_to(message, "Ваши данные были сброшены. Начните снова, загрузив новый документ.")
+    # Stream the answer into a placeholder message instead of waiting for all of it
+    replies = [await bot.reply_to(message, "…")]
+    shown = ["…"]
+    answer = ""
+    last_edit = time.monotonic()
+    try:
+        async for chunk in chat.ask_stream(user_id, message.text):
+            answer += chunk
+            if time.monotonic() - last_edit >= EDIT_INTERVAL:
+                await show_answer(message, replies, shown, answer)
+                last_edit = time.monotonic()
+    except Exception as e:
+        logging.error(f"Ошибка ответа на вопрос: {e}")
+        answer = "Не удалось получить ответ. Пожалуйста, попробуйте позже."
+    # The last periodic edit was usually just now, and an edit right after it is rate-limited
+    await asyncio.sleep(max(0.0, last_edit + EDIT_INTERVAL - time.monotonic()))
+    await show_answer(message, replies, shown, answer, final=True)
+
+
+async def main():
+    # Called here rather than at import time: PDF extraction workers may re-import
+    # this module, and they must not ingest the book again.
+    await initialize_storage_with_book()
+    await bot.infinity_polling()
 
 
 # Start the bot's polling
 if __name__ == '__main__':
-    bot.polling(non_stop=True)
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
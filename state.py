@@ -0,0 +1,163 @@
+import json
+import threading
+from cachetools import LRUCache, TTLCache
+from langchain_core.messages import message_to_dict, messages_from_dict
+from redis import Redis
+
+
+class MessageStore:
+    """
+    Per-user chat histories kept in Redis, with an in-process cache in front of it.
+
+    Each history is a Redis list of serialized messages that expires after ttl seconds
+    without writes, so memory stays bounded and histories survive restarts. The cache
+    saves a Redis round-trip on reads and expires its entries on the same schedule, so
+    it never serves a history Redis has already dropped; it assumes a user's updates
+    are handled by one process. Methods may be called from several threads; get
+    returns a copy, since cached histories are extended in place.
+
+    Attributes:
+        redis (Redis): A client for the Redis server holding the histories.
+        ttl (int): Seconds after the last write before a history expires.
+        local (TTLCache): Recently used histories of this process.
+
+    Methods:
+        get(username: str) -> list:
+            Returns the messages of a user, or None if there is no conversation.
+
+        set(username: str, messages: list) -> None:
+            Replaces the messages of a user.
+
+        append(username: str, *messages) -> None:
+            Appends messages to the conversation of a user.
+
+        delete(username: str) -> None:
+            Deletes the conversation of a user.
+    """
+
+    KEY_PREFIX = "ragout:msgs:"
+
+    def __init__(self, redis: Redis, ttl: int = 3600, maxsize: int = 10_000) -> None:
+        self.redis = redis
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def _key(self, username: str) -> str:
+        return f"{self.KEY_PREFIX}{username}"
+
+    def get(self, username: str):
+        with self._lock:
+            messages = self.local.get(username)
+            if messages is not None:
+                return list(messages)
+        data = self.redis.lrange(self._key(username), 0, -1)
+        if not data:
+            return None
+        messages = messages_from_dict([json.loads(item) for item in data])
+        with self._lock:
+            self.local[username] = messages
+        return list(messages)
+
+    def set(self, username: str, messages: list) -> None:
+        key = self._key(username)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.rpush(key, *(json.dumps(message_to_dict(m)) for m in messages))
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+        with self._lock:
+            self.local[username] = list(messages)
+
+    def append(self, username: str, *messages) -> None:
+        key = self._key(username)
+        pipe = self.redis.pipeline()
+        # RPUSHX never recreates an expired history, which would lose its system prompt
+        pipe.rpushx(key, *(json.dumps(message_to_dict(m)) for m in messages))
+        pipe.expire(key, self.ttl)
+        length, _ = pipe.execute()
+        with self._lock:
+            cached = self.local.pop(username, None)
+            if length and cached is not None:
+                # Re-inserted so the cached copy expires together with the Redis key
+                cached.extend(messages)
+                self.local[username] = cached
+
+    def delete(self, username: str) -> None:
+        self.redis.delete(self._key(username))
+        with self._lock:
+            self.local.pop(username, None)
+
+
+class DocumentStore:
+    """
+    Metadata of the documents each user uploaded, kept in Redis with an in-process LRU
+    cache in front of it.
+
+    Documents of a user are a Redis hash from document id to its JSON metadata. Entries
+    don't expire, because the vectors they point to stay in the vector storage. Ids come
+    from a Redis counter, so uploads handled at the same time by different threads or
+    processes never get the same one. Methods may be called from several threads; get
+    returns a copy, since cached document lists are updated in place.
+
+    Attributes:
+        redis (Redis): A client for the Redis server holding the metadata.
+        local (LRUCache): Recently used document lists of this process.
+
+    Methods:
+        get(user_id: str) -> dict:
+            Returns the documents of a user by document id.
+
+        new_id(user_id: str) -> int:
+            Reserves the id of a new document.
+
+        add(user_id: str, doc_id: int, document: dict) -> None:
+            Stores the metadata of a new document.
+
+        delete(user_id: str) -> None:
+            Deletes all documents of a user.
+    """
+
+    KEY_PREFIX = "ragout:docs:"
+
+    def __init__(self, redis: Redis, maxsize: int = 10_000) -> None:
+        self.redis = redis
+        self.local = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def _key(self, user_id: str) -> str:
+        return f"{self.KEY_PREFIX}{user_id}"
+
+    def _next_key(self, user_id: str) -> str:
+        return f"{self.KEY_PREFIX}{user_id}:next"
+
+    def get(self, user_id: str) -> dict:
+        with self._lock:
+            documents = self.local.get(user_id)
+            if documents is not None:
+                return dict(documents)
+        data = self.redis.hgetall(self._key(user_id))
+        documents = {int(doc_id): json.loads(document) for doc_id, document in data.items()}
+        with self._lock:
+            self.local[user_id] = documents
+        return dict(documents)
+
+    def new_id(self, user_id: str) -> int:
+        next_key = self._next_key(user_id)
+        # Users whose documents predate the counter continue after them
+        self.redis.set(next_key, self.redis.hlen(self._key(user_id)), nx=True)
+        return self.redis.incr(next_key) - 1
+
+    def add(self, user_id: str, doc_id: int, document: dict) -> None:
+        self.redis.hset(self._key(user_id), str(doc_id), json.dumps(document))
+        with self._lock:
+            # An uncached list is loaded from Redis, new document included, on the next get
+            documents = self.local.get(user_id)
+            if documents is not None:
+                documents[doc_id] = document
+
+    def delete(self, user_id: str) -> None:
+        # Numbering starts over with the next upload
+        self.redis.delete(self._key(user_id), self._next_key(user_id))
+        with self._lock:
+            self.local.pop(user_id, None)
@@ -1,23 +1,71 @@
+import asyncio
 import logging
+import uuid
+import diskcache
+import numpy as np
+from blake3 import blake3
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import PointStruct
+from qdrant_client.http.models import (CompressionRatio, Distance, FieldCondition, Filter, FilterSelector, MatchValue,
+                                       PayloadSchemaType, ProductQuantization, ProductQuantizationConfig,
+                                       QuantizationSearchParams, SearchParams, VectorParams)
+
+
+class EmbedCache:
+    """
+    A local content-addressed cache of chunk embeddings.
+
+    Keys are the blake3 hash of the chunk text plus the embedding model name, so a chunk
+    is embedded once per model whichever document it comes from. Vectors are stored as
+    raw float32 bytes.
+
+    Attributes:
+        model (str): Name of the embedding model the cached vectors come from.
+        cache (diskcache.Cache): On-disk key-value store holding the vectors.
+    """
+
+    def __init__(self, model: str, directory: str = './.embedcache') -> None:
+        self.model = model
+        self.cache = diskcache.Cache(directory)
+
+    def key(self, text: str) -> str:
+        return f"{blake3(text.encode()).hexdigest()}:{self.model}"
+
+    def get(self, key: str):
+        data = self.cache.get(key)
+        if data is None:
+            return None
+        return np.frombuffer(data, dtype=np.float32)
+
+    def set(self, key: str, vector: np.ndarray) -> None:
+        self.cache[key] = vector.astype(np.float32).tobytes()
 
 
 class VectorStorage:
     """
     A class that represents a vector storage for chatbot data using Qdrant.
 
+    The collection is created with product quantization, so searches scan compressed
+    vectors and only the best candidates are rescored against the original ones.
+    Vectors use cosine distance, which Qdrant computes as an inner product over
+    vectors it normalizes on insert, and are kept as float32 arrays on the client.
+
     Attributes:
         embeddings (OpenAIEmbeddings): An instance of OpenAIEmbeddings for generating embeddings.
+        embed_cache (EmbedCache): Embeddings of chunks that were already embedded.
         splitter (RecursiveCharacterTextSplitter): An instance of RecursiveCharacterTextSplitter for splitting text into chunks.
-        qdrant_client (QdrantClient): A client for interacting with the Qdrant service.
+        qdrant_client (QdrantClient): A client for interacting with the Qdrant service over gRPC.
         collection_name (str): Name of the collection in Qdrant where vectors are stored.
 
     Methods:
         new_storage(username: str, text: str) -> None:
             Creates a new vector storage for the given username and text.
+            Texts that are already stored are not embedded again, and only chunks missing
+            from the embedding cache are sent to the API.
+
+        new_storage_async(username: str, text: str) -> None:
+            Same as new_storage, but embeds the chunks with concurrent requests.
 
         retrieve(username: str, query: str, top_k: int):
             Retrieves the most similar documents to the given query for the specified username.
@@ -26,25 +74,140 @@ class VectorStorage:
             Resets the vector storage for the specified username.
     """
 
-    def __init__(self, api_key: str, qdrant_host: str = 'localhost', qdrant_port: int = 6333) -> None:
-        self.embeddings = OpenAIEmbeddings(api_key=api_key)
+    # Texts per embeddings request: 512 chunks of ~1000 Cyrillic characters stay
+    # under OpenAI's per-request token cap while keeping the round-trips few.
+    EMBED_BATCH_SIZE = 512
+    # Batch size and number of in-flight requests for the async embedding path.
+    ASYNC_BATCH_SIZE = 256
+    ASYNC_MAX_CONCURRENCY = 10
+    # Dimension of text-embedding-ada-002 vectors.
+    EMBEDDING_DIM = 1536
+    # Points per upload request and number of uploading workers.
+    UPLOAD_BATCH_SIZE = 512
+    UPLOAD_PARALLEL = 4
+    SEARCH_PARAMS = SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=2.0))
+
+    def __init__(self, api_key: str, qdrant_host: str = 'localhost', qdrant_port: int = 6333,
+                 qdrant_grpc_port: int = 6334) -> None:
+        self.embeddings = OpenAIEmbeddings(api_key=api_key, chunk_size=self.EMBED_BATCH_SIZE, max_retries=6)
+        self.embed_cache = EmbedCache(self.embeddings.model)
         self.splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        self.qdrant_client = QdrantClient(host=qdrant_host, port=qdrant_port)
+        self.qdrant_client = QdrantClient(host=qdrant_host, port=qdrant_port, grpc_port=qdrant_grpc_port,
+                                          prefer_grpc=True)
         self.collection_name = 'chatbot_vectors'
+        self._ensure_collection()
+
+    def _ensure_collection(self) -> None:
+        if not self.qdrant_client.collection_exists(self.collection_name):
+            self.qdrant_client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=VectorParams(size=self.EMBEDDING_DIM, distance=Distance.COSINE),
+                quantization_config=ProductQuantization(
+                    product=ProductQuantizationConfig(compression=CompressionRatio.X8, always_ram=True)
+                )
+            )
+        # Every search, count and delete filters by username, so they go through an index
+        # instead of scanning all payloads. Creating an existing index is a no-op.
+        self.qdrant_client.create_payload_index(
+            collection_name=self.collection_name,
+            field_name="username",
+            field_schema=PayloadSchemaType.KEYWORD
+        )
+
+    @staticmethod
+    def _user_filter(username: str, *conditions) -> Filter:
+        return Filter(must=[FieldCondition(key="username", match=MatchValue(value=username)), *conditions])
 
     def new_storage(self, username: str, text: str) -> None:
-        texts = self.splitter.split_text(text)
-        embeddings = self.embeddings.embed_documents(texts)
-        points = [PointStruct(id=i, vector=embedding.tolist(), payload={"text": text}) for i, (embedding, text) in
-                  enumerate(zip(embeddings, texts))]
-        self.qdrant_client.upsert(collection_name=self.collection_name, points=points)
+        doc_hash, texts = self._split(text)
+        if self._has_document(username, doc_hash, len(texts)):
+            logging.info(f"Storage for {username} is up to date, skipping embedding")
+            return
+        embeddings, keys, missing = self._cached_embeddings(texts)
+        if missing:
+            new_embeddings = self.embeddings.embed_documents([texts[i] for i in missing])
+            self._cache_embeddings(embeddings, keys, missing, new_embeddings)
+        self._upload(username, texts, embeddings, doc_hash)
+
+    async def new_storage_async(self, username: str, text: str) -> None:
+        # Splitting, Qdrant calls and the embedding cache's disk reads and writes all
+        # block, so they run in threads to keep the event loop responsive
+        doc_hash, texts = await asyncio.to_thread(self._split, text)
+        if await asyncio.to_thread(self._has_document, username, doc_hash, len(texts)):
+            logging.info(f"Storage for {username} is up to date, skipping embedding")
+            return
+        embeddings, keys, missing = await asyncio.to_thread(self._cached_embeddings, texts)
+        if missing:
+            new_embeddings = await self._aembed_all([texts[i] for i in missing])
+            await asyncio.to_thread(self._cache_embeddings, embeddings, keys, missing, new_embeddings)
+        await asyncio.to_thread(self._upload, username, texts, embeddings, doc_hash)
+
+    def _split(self, text: str) -> tuple:
+        return blake3(text.encode()).hexdigest(), self.splitter.split_text(text)
+
+    def _has_document(self, username: str, doc_hash: str, num_chunks: int) -> bool:
+        # Points carry the hash of the text they were split from, so an unchanged
+        # document is found in the collection and a changed one is not. Point ids are
+        # fixed per chunk, so a document is complete only when every chunk is there;
+        # after a partial upload the missing chunks are uploaded again.
+        result = self.qdrant_client.count(
+            collection_name=self.collection_name,
+            count_filter=self._user_filter(username, FieldCondition(key="doc_hash", match=MatchValue(value=doc_hash)))
+        )
+        return result.count >= num_chunks
+
+    def _cached_embeddings(self, texts: list) -> tuple:
+        # Returns the embeddings found in the cache, their cache keys and the
+        # positions of the texts that still have to be embedded.
+        keys = [self.embed_cache.key(text) for text in texts]
+        embeddings = np.empty((len(texts), self.EMBEDDING_DIM), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            vector = self.embed_cache.get(key)
+            if vector is None:
+                missing.append(i)
+            else:
+                embeddings[i] = vector
+        return embeddings, keys, missing
+
+    def _cache_embeddings(self, embeddings: np.ndarray, keys: list, missing: list, new_embeddings: list) -> None:
+        for i, vector in zip(missing, new_embeddings):
+            embeddings[i] = vector
+            self.embed_cache.set(keys[i], embeddings[i])
+
+    async def _aembed_all(self, texts: list) -> list:
+        semaphore = asyncio.Semaphore(self.ASYNC_MAX_CONCURRENCY)
+
+        async def embed_batch(batch: list) -> list:
+            async with semaphore:
+                return await self.embeddings.aembed_documents(batch)
+
+        batches = [texts[i:i + self.ASYNC_BATCH_SIZE] for i in range(0, len(texts), self.ASYNC_BATCH_SIZE)]
+        # gather keeps the results in batch order, so the vectors line up with texts
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        return [embedding for batch in results for embedding in batch]
+
+    def _upload(self, username: str, texts: list, embeddings: np.ndarray, doc_hash: str) -> None:
+        # Ids are derived from the document and the chunk position, so they don't
+        # collide across documents and re-uploading a document overwrites its points.
+        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{username}/{doc_hash}/{i}")) for i in range(len(texts))]
+        self.qdrant_client.upload_collection(
+            collection_name=self.collection_name,
+            vectors=embeddings,
+            payload=[{"text": text, "username": username, "doc_hash": doc_hash} for text in texts],
+            ids=ids,
+            batch_size=self.UPLOAD_BATCH_SIZE,
+            parallel=self.UPLOAD_PARALLEL
+        )
 
     def retrieve(self, username: str, query: str, top_k: int):
-        query_embedding = self.embeddings.embed_query(query)
+        query_embedding = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
         search_result = self.qdrant_client.search(
             collection_name=self.collection_name,
             query_vector=query_embedding.tolist(),
-            limit=top_k
+            query_filter=self._user_filter(username),
+            limit=top_k,
+            search_params=self.SEARCH_PARAMS
         )
         if not search_result:
             return None
@@ -53,12 +216,9 @@ class VectorStorage:
         return " ".join(documents)
 
     def reset(self, username: str) -> None:
-        # Ищем все точки для данного пользователя
-        filter_params = {
-            "must": [
-                {"key": "username", "match": {"value": username}}
-            ]
-        }
-        # Удаление точек, соответствующих фильтру
-        self.qdrant_client.delete_points(collection_name=self.collection_name, filter=filter_params)
+        # Удаление всех точек данного пользователя
+        self.qdrant_client.delete(
+            collection_name=self.collection_name,
+            points_selector=FilterSelector(filter=self._user_filter(username))
+        )
 
@@ -1,14 +1,42 @@
-from PyPDF2 import PdfReader
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cchardet
+import fitz
+
+# Below this many pages starting worker processes costs more than it saves
+PARALLEL_MIN_PAGES = 256
+
+
+def _extract_pages(data, start, stop):
+    # Documents and pages don't pickle, so each worker opens its own
+    # document over the raw bytes.
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        return "".join(doc[i].get_text() for i in range(start, stop))
 
 
 def get_pdf_text(pdf):
-    text = ""
-    pdf_reader = PdfReader(pdf)
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-    return text
+    data = pdf.read()
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        num_pages = doc.page_count
+        if num_pages < PARALLEL_MIN_PAGES:
+            return "".join(page.get_text() for page in doc)
+    workers = os.cpu_count() or 1
+    step = -(-num_pages // workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_extract_pages, data, start, min(start + step, num_pages))
+                   for start in range(0, num_pages, step)]
+        return "".join(future.result() for future in futures)
 
 def decode_text(file_data):
+    # One detector pass instead of a full decode attempt per candidate encoding
+    detected = cchardet.detect(file_data)
+    if detected['encoding'] and (detected['confidence'] or 0) >= 0.5:
+        try:
+            return file_data.decode(detected['encoding'], errors='replace')
+        except LookupError:
+            # cchardet knows some encodings (EUC-TW, ...) that Python's codecs don't
+            pass
     encodings = ['utf-8', 'windows-1251', 'iso-8859-5', 'latin-1', 'utf-16']
     for encoding in encodings:
         try: